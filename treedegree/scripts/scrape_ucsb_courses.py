@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
-import json
+import hashlib
+import os
 import re
 import sys
-from typing import Optional, List, Dict, Tuple
-
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from functools import cached_property
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional, List, Dict, Tuple
+
+import orjson
 import requests
-from bs4 import BeautifulSoup, Tag
+from lxml import etree
+from lxml import html as lxhtml
+from lxml.html import HtmlElement
 
 URLS = [
     "https://my.sa.ucsb.edu/catalog/2022-2023/CollegesDepartments/ls-intro/stats.aspx?DeptTab=Courses",
@@ -19,64 +29,210 @@ URLS = [
 
 UA = {"User-Agent": "Mozilla/5.0 (compatible; UCSB-Catalog-Scraper/2.1)"}
 
-# Matches "PSTAT 100." (with lots of whitespace allowed)
-COURSE_HEADER_RE = re.compile(r"^\s*([A-Z]{2,10})\s+([0-9]{1,3}[A-Z0-9]{0,6})\s*\.\s*(.+?)\s*$")
-COURSE_CODE_ONLY_RE = re.compile(r"^\s*([A-Z]{2,10})\s+([0-9]{1,3}[A-Z0-9]{0,6})\s*$")
+# all catalog pages live on one host, so one pooled keep-alive session serves every fetch
+FETCH_WORKERS = 8
+_SESSION = requests.Session()
+_SESSION.headers.update(UA)
+_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS))
+
+# catalog pages are static; cache them on disk so re-runs skip the network.
+# Set UCSB_SCRAPER_NO_CACHE=1 to refetch (fresh pages still refresh the cache).
+CACHE_DIR = Path(__file__).resolve().parent / ".cache"
+CACHE_TTL = 24 * 60 * 60  # seconds
+
+# Matches "PSTAT 100. Title" and bare "PSTAT 100." (empty title group); .match() anchors the start
+COURSE_HEADER_RE = re.compile(r"\s*([A-Z]{2,10})\s+([0-9]{1,3}[A-Z0-9]{0,6})\s*\.\s*(.*?)\s*$")
+# "SUBJ NUM. Title" anywhere in a block's text, title up to "(units)" if present
+ANY_HDR_RE = re.compile(r"([A-Z]{2,10})\s+([0-9]{1,3}[A-Z0-9]{0,6})\s*\.\s*([^()]+?)\s*(\(|$)")
+# "(4) Smith; Jones" -> units, instructors
+UNITS_RE = re.compile(r"^\(([^)]+)\)\s*(.*)$")
+# a charset declared by the page itself (<meta charset>, http-equiv, or an XML declaration)
+DECLARED_CHARSET_RE = re.compile(rb"<meta[^>]+charset|<\?xml[^>]+encoding", re.I)
+
+
+def _has_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+def _id_endswith(suffix: str) -> str:
+    return f"substring(@id, string-length(@id) - {len(suffix) - 1}) = '{suffix}'"
+
+
+# compiled once at import; each call is a single C-level walk over the lxml tree
+COURSE_DISPLAY_XP = etree.XPath(f"//div[{_has_class('CourseDisplay')}]")
+# every node the per-course extractors look at, in document order, from one walk per block
+COURSE_PARTS_XP = etree.XPath(
+    ".//strong | .//b"
+    f" | .//span[{_has_class('CourseIdAndTitle')} or {_has_class('InstructorUnits')}]"
+    f" | .//div[{_id_endswith('nonchildcourseContainer')}]"
+)
+# header text nodes straight from the query, no per-node Python iteration for the common case
+HEADER_TEXT_XP = etree.XPath(".//text()", smart_strings=False)
 
 
 class ProgressBar:
+    # redraws are throttled; per-course writes were a format + syscall each
+    min_interval = 0.05  # seconds
+
     def __init__(self, total: int, width: int = 30) -> None:
+        # total counts pages (known up front); courses is a running count of extracted courses
         self.total = max(total, 1)
         self.width = width
         self.current = 0
+        self.courses = 0
+        self._last_write = 0.0
 
-    def update(self, inc: int = 1) -> None:
+    def update(self, inc: int = 1, courses: int = 0) -> None:
         self.current += inc
+        self.courses += courses
+        now = time.monotonic()
+        # finished pages always redraw; per-course ticks are throttled
+        if not inc and now - self._last_write < self.min_interval:
+            return
+        self._last_write = now
+        self._render()
+
+    def _render(self) -> None:
         ratio = min(self.current / self.total, 1.0)
         filled = int(ratio * self.width)
         bar = "█" * filled + "░" * (self.width - filled)
-        sys.stdout.write(f"\rParsed: {self.current}/{self.total} [{bar}] {ratio*100:5.1f}%")
+        sys.stdout.write(
+            f"\rParsed: {self.current}/{self.total} pages [{bar}] {ratio*100:5.1f}%  {self.courses} courses"
+        )
         sys.stdout.flush()
 
     def finish(self) -> None:
-        self.update(0)
+        self._render()
         sys.stdout.write("\n")
         sys.stdout.flush()
 
 
-def fetch(url: str) -> str:
-    r = requests.get(url, headers=UA, timeout=30)
-    r.raise_for_status()
-    return r.text
+class JsonArrayWriter:
+    """Streams a JSON array one element at a time, laid out like orjson's OPT_INDENT_2."""
 
+    def __init__(self, f: BinaryIO) -> None:
+        self.f = f
+        self.count = 0
+        f.write(b"[")
 
-def norm_space(s: str) -> str:
-    return re.sub(r"\s+", " ", s or "").strip()
+    def write(self, item: Dict) -> None:
+        # JSON strings never contain raw newlines, so re-indenting on b"\n" is safe
+        body = orjson.dumps(item, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n  ")
+        self.f.write(b",\n  " if self.count else b"\n  ")
+        self.f.write(body)
+        self.count += 1
+
+    def close(self) -> None:
+        self.f.write(b"\n]" if self.count else b"]")
+
+
+def fetch(url: str) -> bytes:
+    # raw bytes: lxml rejects str input that carries an XML encoding declaration
+    path = CACHE_DIR / f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.html"
+    use_cache = os.environ.get("UCSB_SCRAPER_NO_CACHE", "") in ("", "0")
+    if use_cache and path.exists() and time.time() - path.stat().st_mtime < CACHE_TTL:
+        return path.read_bytes()
+
+    r = _SESSION.get(url, timeout=30)
+    r.raise_for_status()
+    CACHE_DIR.mkdir(exist_ok=True)
+    # write to a temp file and swap it in, so an interrupted run never leaves a truncated page
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(r.content)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return r.content
 
 
-def find_level_group(course_div: Tag) -> Optional[str]:
-    for parent in course_div.parents:
-        if not isinstance(parent, Tag):
+def norm_space(s: str) -> str:
+    # str.split() with no args splits on any whitespace run and drops empties
+    return " ".join(s.split()) if s else ""
+
+
+def text_of(el: HtmlElement) -> str:
+    # same result as BeautifulSoup's norm_space(get_text(" ", strip=True))
+    return norm_space(" ".join(el.itertext()))
+
+
+@dataclass
+class CourseContext:
+    """Derived views of one CourseDisplay block, built once and shared by the extractors."""
+
+    div: HtmlElement
+    id_title: Optional[HtmlElement] = None
+    instructor_units: Optional[HtmlElement] = None
+    container: Optional[HtmlElement] = None
+    first_b: Optional[HtmlElement] = None
+    strongs: List[HtmlElement] = field(default_factory=list)
+
+    def add(self, el: HtmlElement) -> None:
+        if el.tag == "strong":
+            self.strongs.append(el)
+        elif el.tag == "b":
+            if self.first_b is None:
+                self.first_b = el
+        elif el.tag == "div":
+            if self.container is None:
+                self.container = el
+        else:
+            classes = (el.get("class") or "").split()
+            if self.id_title is None and "CourseIdAndTitle" in classes:
+                self.id_title = el
+            if self.instructor_units is None and "InstructorUnits" in classes:
+                self.instructor_units = el
+
+    @cached_property
+    def full_text(self) -> str:
+        # only the last-resort header strategy needs the whole block's text
+        return text_of(self.div)
+
+
+def iter_course_contexts(tree: HtmlElement) -> Iterator[CourseContext]:
+    # scoped per block so nested (child) CourseDisplays still see their own nodes
+    for course_div in COURSE_DISPLAY_XP(tree):
+        ctx = CourseContext(course_div)
+        for el in COURSE_PARTS_XP(course_div):
+            ctx.add(el)
+        yield ctx
+
+
+# ASP.NET repeater ids keep their CamelCase, so plain substring checks suffice
+LEVEL_GROUPS = (
+    ("rptrLowerDivisionCourses", "Lower Division"),
+    ("rptrUpperDivisionCourses", "Upper Division"),
+    ("rptrGraduateDivisionCourses", "Graduate Division"),
+)
+
+# the repeater container sits a few ancestors above each CourseDisplay
+MAX_LEVEL_DEPTH = 8
+
+
+def find_level_group(ctx: CourseContext) -> Optional[str]:
+    for depth, parent in enumerate(ctx.div.iterancestors()):
+        if depth >= MAX_LEVEL_DEPTH:
+            return None
+        pid = parent.get("id")
+        if not pid:
             continue
-        pid = (parent.get("id") or "").lower()
-        if "rptrlowerdivisioncourses" in pid:
-            return "Lower Division"
-        if "rptrupperdivisioncourses" in pid:
-            return "Upper Division"
-        if "rptrgraduatedivisioncourses" in pid:
-            return "Graduate Division"
+        for key, group in LEVEL_GROUPS:
+            if key in pid:
+                return group
     return None
 
 
-def parse_units_and_instructors(course_div: Tag) -> Tuple[Optional[str], List[str]]:
-    span = course_div.select_one("span.InstructorUnits")
-    if not span:
+def parse_units_and_instructors(ctx: CourseContext) -> Tuple[Optional[str], List[str]]:
+    span = ctx.instructor_units
+    if span is None:
         return None, []
-    txt = norm_space(span.get_text(" ", strip=True))
+    txt = text_of(span)
 
     units = None
     instructors_txt = txt
-    m = re.match(r"^\(([^)]+)\)\s*(.*)$", txt)
+    m = UNITS_RE.match(txt)
     if m:
         units = norm_space(m.group(1))
         instructors_txt = norm_space(m.group(2))
@@ -91,16 +247,34 @@ def parse_units_and_instructors(course_div: Tag) -> Tuple[Optional[str], List[st
     return units, instructors
 
 
-def extract_labeled_fields(course_div: Tag) -> Dict[str, Optional[str]]:
-    wanted = {
-        "prerequisite": "prerequisites_raw",
-        "prerequisites": "prerequisites_raw",
-        "recommended preparation": "recommended_preparation_raw",
-        "enrollment comments": "enrollment_comments_raw",
-        "repeat comments": "repeat_comments_raw",
-        "cross-listed": "cross_listed_raw",
-        "crosslisted": "cross_listed_raw",
-    }
+# <strong> label (lowercased, no trailing colon) -> output field
+LABEL_FIELDS = {
+    "prerequisite": "prerequisites_raw",
+    "prerequisites": "prerequisites_raw",
+    "recommended preparation": "recommended_preparation_raw",
+    "enrollment comments": "enrollment_comments_raw",
+    "repeat comments": "repeat_comments_raw",
+    "cross-listed": "cross_listed_raw",
+    "crosslisted": "cross_listed_raw",
+}
+
+# runaway guards for malformed pages where no <strong>/<br> ends a field
+MAX_FIELD_CHARS = 2048
+MAX_FIELD_PARTS = 64
+
+
+def iter_sibling_text(el: HtmlElement) -> Iterator[str]:
+    """Text following `el` up to the next <strong>/<br>, one piece per node."""
+    yield el.tail or ""
+    for sib in el.itersiblings():
+        if sib.tag in ("strong", "br"):
+            return
+        if isinstance(sib.tag, str):  # comments/PIs carry no visible text
+            yield " ".join(sib.itertext())
+        yield sib.tail or ""
+
+
+def extract_labeled_fields(ctx: CourseContext) -> Dict[str, Optional[str]]:
     out: Dict[str, Optional[str]] = {
         "prerequisites_raw": None,
         "recommended_preparation_raw": None,
@@ -109,30 +283,34 @@ def extract_labeled_fields(course_div: Tag) -> Dict[str, Optional[str]]:
         "cross_listed_raw": None,
     }
 
-    for strong in course_div.find_all("strong"):
-        label = norm_space(strong.get_text(" ", strip=True)).rstrip(":").lower()
-        if label not in wanted:
+    for strong in ctx.strongs:
+        # plain-text labels are just .text; skip the itertext walk for those
+        raw = strong.text if len(strong) == 0 else " ".join(strong.itertext())
+        key = LABEL_FIELDS.get(norm_space(raw).rstrip(":").lower())
+        if key is None:
             continue
 
         parts: List[str] = []
-        for sib in strong.next_siblings:
-            if isinstance(sib, Tag):
-                if sib.name in ("strong",):
-                    break
-                if sib.name == "br":
-                    break
-                parts.append(norm_space(sib.get_text(" ", strip=True)))
-            else:
-                parts.append(norm_space(str(sib)))
-
-        val = norm_space(" ".join([p for p in parts if p]))
+        size = 0
+        for piece in iter_sibling_text(strong):
+            # whitespace-only text between tags is the common case; drop it before normalizing
+            if not piece or piece.isspace():
+                continue
+            part = norm_space(piece)
+            parts.append(part)
+            size += len(part)
+            if size > MAX_FIELD_CHARS or len(parts) >= MAX_FIELD_PARTS:
+                break
+
+        # parts are already normalized and non-empty
+        val = " ".join(parts)
         if val:
-            out[wanted[label]] = val
+            out[key] = val
 
     return out
 
 
-def extract_course_header(course_div: Tag) -> Optional[Tuple[str, str, str]]:
+def extract_course_header(ctx: CourseContext) -> Optional[Tuple[str, str, str]]:
     """
     Robustly find (subject, number, title) from a CourseDisplay block.
 
@@ -142,36 +320,27 @@ def extract_course_header(course_div: Tag) -> Optional[Tuple[str, str, str]]:
     3) any text that matches 'SUBJ NUM. Title' inside the block
     """
     # 1) best-case: CourseIdAndTitle
-    id_title = course_div.select_one("span.CourseIdAndTitle")
+    id_title = HEADER_TEXT_XP(ctx.id_title) if ctx.id_title is not None else []
     if id_title:
-        txt = norm_space(id_title.get_text(" ", strip=True))
+        txt = norm_space(" ".join(id_title))
         # CourseIdAndTitle may include only "PSTAT 100." and CourseFullTitle separately;
         # but the combined text usually becomes "PSTAT 100. Data Science..."
         m = COURSE_HEADER_RE.match(txt)
-        if m:
-            return (m.group(1), m.group(2), norm_space(m.group(3)))
-        # fallback if it’s like "PSTAT 100." only
-        if "." in txt:
-            left, right = txt.split(".", 1)
-            left = norm_space(left)
-            title = norm_space(right)
-            m2 = COURSE_CODE_ONLY_RE.match(left)
-            if m2 and title:
-                return (m2.group(1), m2.group(2), title)
+        if m and m.group(3):
+            return (m.group(1), m.group(2), m.group(3))
 
     # 2) first <b> in the CourseDisplay
-    b = course_div.find("b")
-    if b:
-        btxt = norm_space(b.get_text(" ", strip=True))
+    if ctx.first_b is not None:
+        btxt = text_of(ctx.first_b)
         m = COURSE_HEADER_RE.match(btxt)
-        if m:
-            return (m.group(1), m.group(2), norm_space(m.group(3)))
+        if m and m.group(3):
+            return (m.group(1), m.group(2), m.group(3))
 
     # 3) search anywhere in the text for first occurrence
-    full_txt = norm_space(course_div.get_text(" ", strip=True))
+    full_txt = ctx.full_text
     # Find "SUBJ NUM." then capture title up to "(units)" if present
     # Example: "PSTAT 210. Measure Theory (4) STAFF ..."
-    m_any = re.search(r"([A-Z]{2,10})\s+([0-9]{1,3}[A-Z0-9]{0,6})\s*\.\s*([^()]+?)\s*(\(|$)", full_txt)
+    m_any = ANY_HDR_RE.search(full_txt)
     if m_any:
         subj = m_any.group(1)
         num = m_any.group(2)
@@ -182,39 +351,61 @@ def extract_course_header(course_div: Tag) -> Optional[Tuple[str, str, str]]:
     return None
 
 
-def extract_description(course_div: Tag) -> str:
+def iter_description_candidates(el: HtmlElement) -> Iterator[Tuple[HtmlElement, List[str]]]:
+    """
+    Outermost non-label <div>s under `el` (document order) with their normalized strings.
+
+    A div's text contains all of its descendants' text, so a non-label div always
+    outscores the divs nested in it; only label blocks need to be searched inside.
+    """
+    for child in el.iterchildren():
+        if child.tag != "div":
+            yield from iter_description_candidates(child)
+            continue
+        strings = [x for x in map(norm_space, child.itertext()) if x]
+        # skip divs that are basically just prereq/labels (a description may sit inside one);
+        # test the joined text, labels can be split across nodes ("<b>Recommended</b> Preparation:")
+        joined = " ".join(strings)
+        if "Prerequisite:" in joined or "Recommended Preparation:" in joined:
+            yield from iter_description_candidates(child)
+            continue
+        yield child, strings
+
+
+def extract_description(ctx: CourseContext) -> str:
     """
     Description is typically in the inner <div> after the <i> prereq block.
     We'll choose the deepest div with the most non-metadata text.
     """
     # If there is a container div (nonchildcourseContainer), prefer its child divs
-    container = course_div.select_one("div[id$='nonchildcourseContainer']") or course_div
+    container = ctx.container if ctx.container is not None else ctx.div
 
-    best_text = ""
-    for d in container.find_all("div"):
-        txt = norm_space(d.get_text(" ", strip=True))
-        if not txt:
-            continue
-        # skip divs that are basically just prereq/labels
-        if "Prerequisite:" in txt or "Recommended Preparation:" in txt:
-            continue
-        if len(txt) > len(best_text):
-            best_text = txt
+    # score candidates by text length without concatenating each subtree;
+    # only the winning div gets rendered with text_of
+    best: Optional[HtmlElement] = None
+    best_len = 0
+    for d, strings in iter_description_candidates(container):
+        # same length text_of(d) would produce
+        cur_len = sum(len(x) for x in strings) + len(strings) - 1
+        if cur_len > best_len:
+            best, best_len = d, cur_len
 
-    return best_text
+    if best is None:
+        return ""
+    return text_of(best)
 
 
-def parse_course(course_div: Tag, source_url: str) -> Optional[Dict]:
-    header = extract_course_header(course_div)
+def parse_course(ctx: CourseContext, source_url: str) -> Optional[Dict]:
+    header = extract_course_header(ctx)
     if not header:
         return None  # skip non-course blocks safely
 
     subject, number, title = header
 
-    units, instructors = parse_units_and_instructors(course_div)
-    level_group = find_level_group(course_div)
-    labeled = extract_labeled_fields(course_div)
-    description = extract_description(course_div)
+    units, instructors = parse_units_and_instructors(ctx)
+    level_group = find_level_group(ctx)
+    labeled = extract_labeled_fields(ctx)
+    description = extract_description(ctx)
 
     return {
         "subject": subject,
@@ -234,41 +425,75 @@ def parse_course(course_div: Tag, source_url: str) -> Optional[Dict]:
     }
 
 
-def main():
-    pages: List[Tuple[str, str]] = []
-    total_est = 0
+# pages without a declared charset are UTF-8; libxml2 would otherwise fall back to Latin-1
+_UTF8_PARSER = lxhtml.HTMLParser(encoding="utf-8")
 
-    # first pass: fetch + estimate how many REAL courses (header extractable)
-    for url in URLS:
-        html = fetch(url)
-        pages.append((url, html))
-        soup = BeautifulSoup(html, "html.parser")
-        for cd in soup.select("div.CourseDisplay"):
-            if extract_course_header(cd):
-                total_est += 1
 
-    bar = ProgressBar(total=total_est)
+def parse_page(html: bytes) -> List[CourseContext]:
+    parser = None if DECLARED_CHARSET_RE.search(html, 0, 2048) else _UTF8_PARSER
+    try:
+        tree = lxhtml.document_fromstring(html, parser=parser)
+    except etree.ParserError:
+        # empty/whitespace-only body; BeautifulSoup just returned an empty soup here
+        return []
+    # BeautifulSoup's get_text never included script/style text; empty them in place rather
+    # than unlinking, so their tails stay separate text nodes ("desc<style/>more" -> "desc more")
+    for el in tree.iter("script", "style"):
+        el.clear(keep_tail=True)
+    return list(iter_course_contexts(tree))
 
-    all_courses: List[Dict] = []
+
+def main():
+    out_path = "ucsb_2022_2023_courses.json"
+    tmp_path = out_path + ".tmp"
+
+    bar = ProgressBar(total=len(URLS))
+
+    # pages can finish out of order; only those waiting on an earlier URL are buffered
+    pending: Dict[str, List[Dict]] = {}
+    next_page = 0
     skipped = 0
 
-    for url, html in pages:
-        soup = BeautifulSoup(html, "html.parser")
-        for cd in soup.select("div.CourseDisplay"):
-            course = parse_course(cd, url)
-            if not course:
-                skipped += 1
-                continue
-            all_courses.append(course)
-            bar.update(1)
+    try:
+        with open(tmp_path, "wb") as f:
+            out = JsonArrayWriter(f)
+
+            # fetch concurrently (network-bound) and parse each page as soon as it lands,
+            # while the remaining pages are still downloading
+            with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(URLS))) as ex:
+                futures = {ex.submit(fetch, url): url for url in URLS}
+                for fut in as_completed(futures):
+                    url = futures[fut]
+                    courses: List[Dict] = []
+                    for ctx in parse_page(fut.result()):
+                        course = parse_course(ctx, url)
+                        if not course:
+                            skipped += 1
+                            continue
+                        courses.append(course)
+                        bar.update(0, courses=1)
+                    pending[url] = courses
+                    bar.update(1)
+
+                    # write in URLS order regardless of which page finished first
+                    while next_page < len(URLS) and URLS[next_page] in pending:
+                        for course in pending.pop(URLS[next_page]):
+                            out.write(course)
+                        next_page += 1
+
+            out.close()
+
+        # only replace the previous output once the whole array is written
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        # don't leave a partial .tmp behind when a fetch or parse fails
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
 
     bar.finish()
 
-    out_path = "ucsb_2022_2023_courses.json"
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(all_courses, f, ensure_ascii=False, indent=2)
-
-    print(f"Wrote {len(all_courses)} courses -> {out_path}")
+    print(f"Wrote {out.count} courses -> {out_path}")
     print(f"Skipped {skipped} non-course CourseDisplay blocks.")
 
 